@@ -12,18 +12,53 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Optional
+from typing import List, Optional
+import functools
 import io
 
 import numpy as np
 
 import torch
-from torch.utils._pytree import tree_map
 
 import iree.runtime as ireert
 import iree.compiler as ireec
 
 
+def _map_leaves(fn, leaf_type, value):
+    """Apply `fn` to the `leaf_type` values in nested tuples, lists and dicts.
+
+    This runs on every invocation, so containers are dispatched on their exact
+    type rather than going through the generic pytree machinery. Subclasses of
+    these containers (e.g. namedtuples or `OrderedDict`s) are not supported
+    and raise a `TypeError`, rather than silently leaving their contents
+    unconverted. Other values are returned unchanged.
+    """
+    value_type = type(value)
+    if value_type is tuple:
+        return tuple(_map_leaves(fn, leaf_type, x) for x in value)
+    if value_type is list:
+        return [_map_leaves(fn, leaf_type, x) for x in value]
+    if value_type is dict:
+        return {k: _map_leaves(fn, leaf_type, v) for k, v in value.items()}
+    if isinstance(value, leaf_type):
+        return fn(value)
+    if isinstance(value, (tuple, list, dict)):
+        raise TypeError(f"Unsupported container type: {value_type.__name__}")
+    return value
+
+
+def _device_array_to_torch(x):
+    # TODO: Investigate why a copy is needed here.
+    # Without the copy, certain sets of tests, when run together, will
+    # cause a segfault when the process is exiting.
+    # It seems to be related to Torch attempting to free a Numpy array
+    # that is backed by IREE memory, resulting in
+    # iree_hal_buffer_view_release reading from a null pointer.
+    # `to_host` maps the device buffer directly instead of going through the
+    # numpy array protocol, and makes the device-to-host transfer explicit.
+    return torch.from_numpy(x.to_host().copy())
+
+
 class IREEInvoker:
     """A wrapper around an IREE module that provides a Pythonic interface.
     
@@ -37,25 +72,23 @@ class IREEInvoker:
         self.device = iree_module._context.config.device
 
     def __getattr__(self, function_name: str):
+        try:
+            iree_function = self._iree_module[function_name]
+        except KeyError:
+            raise AttributeError(
+                f"IREE module has no function {function_name!r}") from None
+        device = self.device
+        def wrap(x):
+            return ireert.asdevicearray(device, x)
         def invoke(*args):
-            def wrap(x):
-                if isinstance(x, torch.Tensor):
-                    return ireert.asdevicearray(self.device, x)
-                return x
-            def unwrap(x):
-                if isinstance(x, ireert.DeviceArray):
-                    return torch.from_numpy(np.asarray(x).copy())
-                return x
             # TODO: Investigate how to share CUDA arrays between IREE and Torch.
-            iree_args = tree_map(wrap, args)
-            result = self._iree_module[function_name](*iree_args)
-            # TODO: Investigate why a copy is needed here.
-            # Without the copy, certain sets of tests, when run together, will
-            # cause a segfault when the process is exiting.
-            # It seems to be related to Torch attempting to free a Numpy array
-            # that is backed by IREE memory, resulting in
-            # iree_hal_buffer_view_release reading from a null pointer.
-            return tree_map(unwrap, result)
+            iree_args = _map_leaves(wrap, torch.Tensor, args)
+            result = iree_function(*iree_args)
+            return _map_leaves(_device_array_to_torch, ireert.DeviceArray,
+                               result)
+        # Store the bound function on the instance so that later calls find it
+        # directly instead of going through `__getattr__` again.
+        setattr(self, function_name, invoke)
         return invoke
 
 
@@ -66,31 +99,32 @@ class NumpyIREEInvoker:
         self.iree_invoker = iree_invoker
 
     def __getattr__(self, function_name: str):
+        torch_function = getattr(self.iree_invoker, function_name)
         def invoke(*args):
-            def wrap(x):
-                if isinstance(x, np.ndarray):
-                    return torch.from_numpy(x)
-                return x
-            def unwrap(x):
-                if isinstance(x, torch.Tensor):
-                    return x.numpy()
-                return x
-            torch_args = tree_map(wrap, args)
-            result = getattr(self.iree_invoker, function_name)(*torch_args)
-            return tree_map(unwrap, result)
+            torch_args = _map_leaves(torch.from_numpy, np.ndarray, args)
+            result = torch_function(*torch_args)
+            return _map_leaves(torch.Tensor.numpy, torch.Tensor, result)
+        setattr(self, function_name, invoke)
         return invoke
 
 
 def compile_to_vmfb(mlir_module, target_backend="llvm-cpu",
-                    cuda_llvm_target_arch: Optional[str] = None):
+                    cuda_llvm_target_arch: Optional[str] = None,
+                    extra_args: Optional[List[str]] = None):
     """Compile an MLIR module to an IREE Flatbuffer.
 
     The module is expected to be in the format produced by `torch_mlir.compile`
     with `OutputType.LINALG_ON_TENSORS`.
 
-    TODO: Expose more compiler options.
+    This does not touch the IREE runtime, so the returned bytes can be saved
+    and later passed to `load_vmfb` in another process or on another machine.
+    The flatbuffer is specific to `target_backend`, so it must be loaded with
+    the same backend and should be part of any key used to cache it.
+
+    `extra_args` are passed through to the IREE compiler, e.g. to tune code
+    generation for the host CPU with `--iree-llvm-target-cpu=host`.
     """
-    extra_args = []
+    extra_args = list(extra_args or [])
     if cuda_llvm_target_arch is not None:
         arch_flag = f"--iree-hal-cuda-llvm-target-arch={cuda_llvm_target_arch}"
         extra_args.append(arch_flag)
@@ -114,12 +148,19 @@ def _map_target_backend_to_driver(target_backend):
         return "local-sync"
     raise ValueError(f"Unknown target backend: {target_backend}")
 
+@functools.lru_cache(maxsize=None)
+def _get_config(driver_name: str) -> ireert.Config:
+    # Creating a config initializes the HAL driver and device, which is much
+    # more expensive than creating a context, so share it between loads.
+    return ireert.Config(driver_name=driver_name)
+
 def load_vmfb(flatbuffer, backend="llvm-cpu"):
     """Load an IREE Flatbuffer into an in-process runtime wrapper.
 
-    The wrapper accepts and returns `torch.Tensor` types.
+    The flatbuffer must have been produced by `compile_to_vmfb` for the same
+    `backend`. The wrapper accepts and returns `torch.Tensor` types.
     """
-    config = ireert.Config(driver_name=_map_target_backend_to_driver(backend))
+    config = _get_config(_map_target_backend_to_driver(backend))
     ctx = ireert.SystemContext(config=config)
     vm_module = ireert.VmModule.from_flatbuffer(ctx.instance, flatbuffer)
     ctx.add_vm_module(vm_module)
@@ -19,6 +19,7 @@ import os
 import re
 import sys
 
+import multiprocess as mp
 import torch
 from torch.utils._pytree import tree_map
 
@@ -36,7 +37,7 @@ from torch_mlir_e2e_test.test_suite import register_all_tests
 register_all_tests()
 
 # https://github.com/iree-org/iree/issues/11457
-_common_iree_issue_11457_xfail_set = {
+_common_iree_issue_11457_xfail_set = frozenset({
     "MeanDimKeepdimModule_basic",
     "MeanDimLargeInputModule_basic",
     "MeanDimModule_basic",
@@ -58,11 +59,11 @@ _common_iree_issue_11457_xfail_set = {
     "VarDimNegativeModule_basic",
     "VarDimUnbiasedModule_basic",
     "VarMeanCorrectionModule_basic",
-}
+})
 
 # Tests that fail due to incomplete support for RNG.
 # In particular, the torch_c.get_next_seed op.
-_common_rng_xfail_set = {
+_common_rng_xfail_set = frozenset({
     "DropoutTrainModule_basic",
     "UniformModule_basic",
     "UniformStaticModule_basic",
@@ -78,10 +79,10 @@ _common_rng_xfail_set = {
     "RandnDtypeDeviceModule_basic",
     "RandnGeneratorModule_basic",
     "RandnModule_basic",
-}
+})
 
 # F64 and i64 related failures: https://github.com/google/iree/issues/8826
-_common_unsupported_data_types_xfail_set = {
+_common_unsupported_data_types_xfail_set = frozenset({
     "SoftmaxIntArgTypeF64Module_basic",
     "LogSoftmaxIntModule_basic",
     "NumToTensorFloatModule_basic",
@@ -139,13 +140,13 @@ _common_unsupported_data_types_xfail_set = {
     "UpSampleNearest2dBackward_basic",
     "UpSampleNearest2dBackwardScalesNone_basic",
     "UpSampleNearest2d_basic",
-}
+})
 
-DYLIB_XFAIL_SET = COMMON_TORCH_MLIR_LOWERING_XFAILS | _common_rng_xfail_set | _common_unsupported_data_types_xfail_set | _common_iree_issue_11457_xfail_set
-VMVX_XFAIL_SET = COMMON_TORCH_MLIR_LOWERING_XFAILS | _common_rng_xfail_set | _common_unsupported_data_types_xfail_set
+DYLIB_XFAIL_SET = frozenset(COMMON_TORCH_MLIR_LOWERING_XFAILS | _common_rng_xfail_set | _common_unsupported_data_types_xfail_set | _common_iree_issue_11457_xfail_set)
+VMVX_XFAIL_SET = frozenset(COMMON_TORCH_MLIR_LOWERING_XFAILS | _common_rng_xfail_set | _common_unsupported_data_types_xfail_set)
 
 # Tests that we need to globally exclude from the list.
-GLOBALLY_EXCLUDED_TESTS = {
+GLOBALLY_EXCLUDED_TESTS = frozenset({
     # These are actually F64-related issues, but because of how the test works,
     # the garbage that IREE returns sometimes passes the test. So the result
     # is nondeterministic and cannot be XFAIL'ed.
@@ -155,7 +156,7 @@ GLOBALLY_EXCLUDED_TESTS = {
     # This test segfaults with the torch_mlir Python package from the releases
     # page, but not with the one built from source. Unclear why.
     "Aten_EmbeddingBagExample_basic",
-}
+})
 
 class IREELinalgOnTensorsBackend(LinalgOnTensorsBackend):
 
@@ -173,8 +174,8 @@ class IREELinalgOnTensorsBackend(LinalgOnTensorsBackend):
           imported_module: The MLIR module consisting of funcs in the torch
             dialect.
         Returns:
-          An opaque, backend specific compiled artifact object that can be
-          passed to `load`.
+          The IREE flatbuffer for `self.backend`, as returned by
+          `iree_torch.compile_to_vmfb`, which can be passed to `load`.
         """
         return iree_torch.compile_to_vmfb(imported_module, self.backend)
 
@@ -189,30 +190,43 @@ class IREELinalgOnTensorsBackend(LinalgOnTensorsBackend):
 # ==============================================================================
 
 
-def dump_standalone_test_artifacts(artifact_dump_dir: str, tests):
-    os.makedirs(artifact_dump_dir, exist_ok=True)
-    for test in tests:
-        captured_imported_module = None
+def _dump_standalone_test_artifact(artifact_dump_dir: str, test):
+    captured_imported_module = None
+
+    class CaptureImportedModule(LinalgOnTensorsBackend):
+        def compile(self, imported_module):
+            nonlocal captured_imported_module
+            captured_imported_module = imported_module
+            return None
 
-        class CaptureImportedModule(LinalgOnTensorsBackend):
-            def compile(self, imported_module):
-                nonlocal captured_imported_module
-                captured_imported_module = imported_module
-                return None
+        def load(self, artifact):
+            return None
 
-            def load(self, artifact):
-                return None
+    try:
+        LinalgOnTensorsBackendTestConfig(
+            CaptureImportedModule()).compile(test.program_factory())
+    except:
+        return
 
-        try:
-            LinalgOnTensorsBackendTestConfig(
-                CaptureImportedModule()).compile(test.program_factory())
-        except:
-            continue
+    assert captured_imported_module is not None
 
-        assert captured_imported_module is not None
+    with open(os.path.join(artifact_dump_dir, test.unique_name + ".mlir"), "w") as f:
+        f.write(str(captured_imported_module))
 
-        with open(os.path.join(artifact_dump_dir, test.unique_name + ".mlir"), "w") as f:
-            f.write(str(captured_imported_module))
+
+def dump_standalone_test_artifacts(artifact_dump_dir: str, tests,
+                                   sequential=False):
+    os.makedirs(artifact_dump_dir, exist_ok=True)
+    if sequential:
+        for test in tests:
+            _dump_standalone_test_artifact(artifact_dump_dir, test)
+        return
+    # Each test is imported independently, so spread them over all cores.
+    # `multiprocess` (rather than `multiprocessing`) is needed to pickle the
+    # test program factories, same as in `run_tests`.
+    with mp.Pool() as pool:
+        pool.starmap(_dump_standalone_test_artifact,
+                     [(artifact_dump_dir, test) for test in tests])
 
 
 # ==============================================================================
@@ -241,7 +255,7 @@ Regular expression specifying which tests to include in this run.
     parser.add_argument('-s', '--sequential',
                         default=False,
                         action='store_true',
-                        help='''Run tests sequentially rather than in parallel.
+                        help='''Run tests (or dump artifacts) sequentially rather than in parallel.
 This can be useful for debugging, since it runs the tests in the same process,
 which make it easier to attach a debugger or get a stack trace.''')
     parser.add_argument('--dump-standalone-test-artifacts',
@@ -259,9 +273,10 @@ def main():
 
     all_tests_to_attempt = list(sorted(
         test for test in GLOBAL_TEST_REGISTRY if test.unique_name not in GLOBALLY_EXCLUDED_TESTS))
+    filter_pattern = re.compile(args.filter)
     tests = [
         test for test in all_tests_to_attempt
-        if re.match(args.filter, test.unique_name)
+        if filter_pattern.match(test.unique_name)
     ]
     if len(tests) == 0:
         print(
@@ -282,7 +297,7 @@ def main():
     config = LinalgOnTensorsBackendTestConfig(iree_backend)
     if args.dump_standalone_test_artifacts:
         dump_standalone_test_artifacts(
-            args.dump_standalone_test_artifacts_dir, tests)
+            args.dump_standalone_test_artifacts_dir, tests, args.sequential)
         sys.exit(0)
     results = run_tests(tests, config, args.sequential, args.verbose)
     failed = report_results(results, xfail_set, args.verbose)
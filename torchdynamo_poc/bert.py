@@ -19,7 +19,8 @@ import torch
 import torchdynamo
 from transformers import BertConfig, AutoModelForMaskedLM
 
-from utils import check_results, print_time_stats, make_torch_mlir_compiler, timeit
+from utils import (check_results, print_compile_cache_stats, print_phase_times,
+                   print_time_stats, make_torch_mlir_compiler, timeit)
 
 
 def run(func: Callable[[], List[torch.Tensor]], iters):
@@ -53,6 +54,8 @@ def main():
                         help="Number of iterations to run model for warmup.")
     parser.add_argument("--device", type=str, choices=["cpu", "cuda"], default="cpu",
                         help="Device to run model on.")
+    parser.add_argument("--target-host-cpu", action="store_true",
+                        help="Tune CPU code generation for the host CPU.")
     args = parser.parse_args()
 
     max_length = 128
@@ -62,7 +65,8 @@ def main():
     model = AutoModelForMaskedLM.from_config(config)
     model.eval()
 
-    compiler = make_torch_mlir_compiler(use_tracing=False, device=args.device)
+    compiler = make_torch_mlir_compiler(use_tracing=False, device=args.device,
+                                        target_host_cpu=args.target_host_cpu)
 
     total_iters = args.warmup_iters + args.iters
     compiled_results, compiled_iteration_times = benchmark_model(
@@ -71,6 +75,10 @@ def main():
         model, input_tensor, "eager", args.device, total_iters)
     print("Compiled iteration times")
     print_time_stats(compiled_iteration_times[args.warmup_iters:])
+    print("Compilation cache")
+    print_compile_cache_stats()
+    print("Time spent per phase (including warmup)")
+    print_phase_times()
     print("Eager iteration times")
     print_time_stats(eager_iteration_times[args.warmup_iters:])
 
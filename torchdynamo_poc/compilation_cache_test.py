@@ -0,0 +1,203 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import torch
+
+import utils
+from utils import _VmfbCache, _graph_cache_key, zstandard
+
+
+class TestGraphCacheKey(unittest.TestCase):
+    @staticmethod
+    def key(module, example_inputs=(torch.rand(1, 1, 6, 6),)):
+        fx_graph = torch.fx.symbolic_trace(module)
+        return _graph_cache_key(fx_graph, list(example_inputs), "llvm-cpu")
+
+    def test_same_graph_same_key(self):
+        torch.manual_seed(0)
+        first = torch.nn.Linear(4, 4)
+        second = torch.nn.Linear(4, 4)
+        second.load_state_dict(first.state_dict())
+        inputs = [torch.rand(2, 4)]
+        self.assertEqual(self.key(first, inputs), self.key(second, inputs))
+
+    def test_different_weights(self):
+        inputs = [torch.rand(2, 4)]
+        self.assertNotEqual(self.key(torch.nn.Linear(4, 4), inputs),
+                            self.key(torch.nn.Linear(4, 4), inputs))
+
+    def test_different_input_shapes(self):
+        module = torch.nn.ReLU()
+        self.assertNotEqual(self.key(module, [torch.rand(2, 4)]),
+                            self.key(module, [torch.rand(4, 2)]))
+
+    def test_different_submodule_config(self):
+        self.assertNotEqual(self.key(torch.nn.MaxPool2d(2)),
+                            self.key(torch.nn.MaxPool2d(3)))
+
+    def test_different_training_mode(self):
+        self.assertNotEqual(self.key(torch.nn.Dropout().train()),
+                            self.key(torch.nn.Dropout().eval()))
+
+    def test_different_non_persistent_buffer(self):
+        class AddOffset(torch.nn.Module):
+            def __init__(self, value):
+                super().__init__()
+                self.register_buffer("offset", torch.full((6,), value),
+                                     persistent=False)
+
+            def forward(self, x):
+                return x + self.offset
+
+        self.assertNotEqual(self.key(AddOffset(0.0)), self.key(AddOffset(1.0)))
+
+    def test_different_options(self):
+        fx_graph = torch.fx.symbolic_trace(torch.nn.ReLU())
+        inputs = [torch.rand(2, 4)]
+        self.assertNotEqual(_graph_cache_key(fx_graph, inputs, "llvm-cpu"),
+                            _graph_cache_key(fx_graph, inputs, "cuda"))
+
+
+class TestCompileCache(unittest.TestCase):
+    def setUp(self):
+        cache_home = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_home.cleanup)
+        env = mock.patch.dict(os.environ, {"XDG_CACHE_HOME": cache_home.name})
+        env.start()
+        self.addCleanup(env.stop)
+        compile_cache = mock.patch.dict(utils._COMPILE_CACHE, clear=True)
+        compile_cache.start()
+        self.addCleanup(compile_cache.stop)
+        self.compiler = utils.make_torch_mlir_compiler(use_tracing=True,
+                                                       device="cpu")
+
+    def compile_and_run(self, func, example_inputs):
+        fx_graph = torch.fx.symbolic_trace(func)
+        return self.compiler(fx_graph, example_inputs)(*example_inputs)
+
+    def test_unwrapped_tuple_and_tensor_returns(self):
+        # Both graphs are `return x` once the one-element tuple is unwrapped.
+        inputs = [torch.rand(10)]
+        self.assertIsInstance(self.compile_and_run(lambda x: x, inputs),
+                              torch.Tensor)
+        result = self.compile_and_run(lambda x: (x,), inputs)
+        self.assertIsInstance(result, tuple)
+        self.assertEqual(len(result), 1)
+        self.assertIsInstance(self.compile_and_run(lambda x: x, inputs),
+                              torch.Tensor)
+
+
+class TestVmfbCache(unittest.TestCase):
+    def setUp(self):
+        cache_home = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_home.cleanup)
+        env = mock.patch.dict(os.environ, {"XDG_CACHE_HOME": cache_home.name})
+        env.start()
+        self.addCleanup(env.stop)
+        os.environ.pop("IREE_TORCH_DISABLE_VMFB_CACHE", None)
+        self.cache = _VmfbCache()
+
+    def path(self, key):
+        return self.cache._get_path(key)
+
+    def test_miss(self):
+        self.assertIsNone(self.cache.get("a" * 64))
+
+    def test_round_trip(self):
+        flatbuffer = bytes(range(256)) * 16
+        self.cache.put("a" * 64, flatbuffer)
+        self.assertEqual(self.cache.get("a" * 64), flatbuffer)
+
+    @unittest.skipIf(zstandard is None, "zstandard is not installed")
+    def test_entries_are_compressed(self):
+        flatbuffer = b"\0" * 4096
+        self.cache.put("a" * 64, flatbuffer)
+        self.assertTrue(self.path("a" * 64).endswith(".zst"))
+        self.assertLess(os.path.getsize(self.path("a" * 64)), len(flatbuffer))
+        self.assertEqual(self.cache.get("a" * 64), flatbuffer)
+
+    def test_put_leaves_no_temporary_files(self):
+        self.cache.put("a" * 64, b"first")
+        self.cache.put("a" * 64, b"second")
+        self.assertEqual(os.listdir(self.cache.get_dir()),
+                         [os.path.basename(self.path("a" * 64))])
+        self.assertEqual(self.cache.get("a" * 64), b"second")
+
+    def test_failed_put_is_not_visible(self):
+        with mock.patch("os.replace", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                self.cache.put("a" * 64, b"data")
+        self.assertEqual(os.listdir(self.cache.get_dir()), [])
+        self.assertIsNone(self.cache.get("a" * 64))
+
+    def test_evicts_least_recently_used(self):
+        a, b, c = "a" * 64, "b" * 64, "c" * 64
+        self.cache.put(a, b"\0" * 1024)
+        self.cache.put(b, b"\0" * 1024)
+        os.utime(self.path(a), (1000, 1000))
+        os.utime(self.path(b), (2000, 2000))
+        # Reading `a` makes it more recently used than `b`.
+        self.cache.get(a)
+        self.cache.max_size = (os.path.getsize(self.path(a)) +
+                               os.path.getsize(self.path(b)))
+        self.cache.put(c, b"\0" * 1024)
+        self.assertTrue(os.path.exists(self.path(a)))
+        self.assertFalse(os.path.exists(self.path(b)))
+        self.assertTrue(os.path.exists(self.path(c)))
+
+    def test_get_tolerates_concurrent_eviction(self):
+        self.cache.put("a" * 64, b"data")
+        with mock.patch("os.utime", side_effect=FileNotFoundError):
+            self.assertEqual(self.cache.get("a" * 64), b"data")
+
+    @unittest.skipIf(zstandard is None, "zstandard is not installed")
+    def test_corrupt_entry_is_a_miss(self):
+        self.cache.put("a" * 64, b"data")
+        with open(self.path("a" * 64), "wb") as f:
+            f.write(b"not zstd")
+        self.assertIsNone(self.cache.get("a" * 64))
+        self.assertFalse(os.path.exists(self.path("a" * 64)))
+
+    def test_evict_tolerates_concurrent_eviction(self):
+        evicted = mock.Mock(path=self.path("b" * 64),
+                            stat=mock.Mock(side_effect=FileNotFoundError))
+        evicted.name = os.path.basename(evicted.path)
+        os.makedirs(self.cache.get_dir())
+        real_scandir = os.scandir
+        with mock.patch("os.scandir",
+                        lambda path: [evicted, *real_scandir(path)]):
+            self.cache.put("a" * 64, b"data")
+        self.assertEqual(self.cache.get("a" * 64), b"data")
+
+    def test_empty_xdg_cache_home(self):
+        with mock.patch.dict(os.environ, {"XDG_CACHE_HOME": "",
+                                          "HOME": "/home/user"}):
+            self.assertEqual(self.cache.get_dir(),
+                             "/home/user/.cache/iree_torch")
+
+    def test_disabled(self):
+        with mock.patch.dict(os.environ, {"IREE_TORCH_DISABLE_VMFB_CACHE": "1"}):
+            self.cache.put("a" * 64, b"data")
+            self.assertFalse(os.path.exists(self.cache.get_dir()))
+        self.cache.put("a" * 64, b"data")
+        with mock.patch.dict(os.environ, {"IREE_TORCH_DISABLE_VMFB_CACHE": "1"}):
+            self.assertIsNone(self.cache.get("a" * 64))
+
+
+if __name__ == "__main__":
+    unittest.main()
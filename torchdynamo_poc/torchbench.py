@@ -23,7 +23,8 @@ import torch
 from torchbenchmark import load_model_by_name
 import torchdynamo
 
-from utils import check_results, print_time_stats, make_torch_mlir_compiler, timeit
+from utils import (check_results, print_compile_cache_stats, print_phase_times,
+                   print_time_stats, make_torch_mlir_compiler, timeit)
 
 
 def run(func: Callable[[], List[torch.Tensor]], num_iter):
@@ -40,8 +41,9 @@ def main():
     parser.add_argument("--train", action="store_true", help="Run model in training mode.")
     parser.add_argument("--iters", type=int, default=1,
                         help="Number of iterations to run model for.")
-    parser.add_argument("--warmup-iters", type=int, default=0,
-                        help="Number of iterations to run model for warmup.")
+    parser.add_argument("--warmup-iters", type=int, default=1,
+                        help="Number of iterations to run model for warmup. "
+                        "The first iteration includes compilation time.")
     parser.add_argument("--batchsize", type=int, default=0,
                         help="Batch size to use in model.")
     parser.add_argument("--trace", action="store_true", help="Use torch.jit.trace on model.")
@@ -50,6 +52,8 @@ def main():
                         help="Verify results with PyTorch eager-mode.")
     parser.add_argument("--device", type=str, choices=["cpu", "cuda"], default="cpu",
                         help="Device to run model on.")
+    parser.add_argument("--target-host-cpu", action="store_true",
+                        help="Tune CPU code generation for the host CPU.")
     args = parser.parse_args()
 
     Model = load_model_by_name(args.model)
@@ -65,8 +69,9 @@ def main():
     model = Model(device="cpu", test=test, jit=False, batch_size=args.batchsize)
     print(f"Running model {args.model}")
 
+    compiler = make_torch_mlir_compiler(args.trace, args.device,
+                                        target_host_cpu=args.target_host_cpu)
     def custom_compiler(graph, inputs):
-        compiler = make_torch_mlir_compiler(args.trace, args.device)
         if args.exit_on_error:
             try:
                 return compiler(graph, inputs)
@@ -75,16 +80,29 @@ def main():
                 sys.exit(1)
         return compiler(graph, inputs)
 
+    total_iters = args.warmup_iters + args.iters
+    # Make sure that frames recompiled on some iterations are not sent back to
+    # eager mode for the rest of the run, which would skew the timings.
+    torchdynamo.config.cache_size_limit = max(
+        torchdynamo.config.cache_size_limit, total_iters)
+
     compiled_iteration_times = []
     @timeit(append_time_to=compiled_iteration_times)
     @torchdynamo.optimize(custom_compiler)
     def run_model_compiled():
         return list(model.invoke())
 
-    total_iters = args.warmup_iters + args.iters
-    compiled_results = run(run_model_compiled, total_iters)
+    # Eval runs never need autograd, so disable it for the whole run. This
+    # avoids recording autograd state in the code Dynamo leaves to eager mode
+    # between compiled graphs, and keeps the grad mode guard stable.
+    with torch.set_grad_enabled(args.train):
+        compiled_results = run(run_model_compiled, total_iters)
     print("Compiled iteration times")
     print_time_stats(compiled_iteration_times[args.warmup_iters:])
+    print("Compilation cache")
+    print_compile_cache_stats()
+    print("Time spent per phase (including warmup)")
+    print_phase_times()
 
     if args.check_with_eager:
         if args.device != "cpu":
@@ -105,7 +123,8 @@ def main():
         def run_model_eager():
             return list(model.invoke())
         torchdynamo.reset()
-        eager_results = run(run_model_eager, total_iters)
+        with torch.set_grad_enabled(args.train):
+            eager_results = run(run_model_eager, total_iters)
         print("Eager iteration times")
         print_time_stats(eager_iteration_times[args.warmup_iters:])
         check_results(compiled_results, eager_results)
@@ -12,9 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import contextlib
 import functools
+import importlib.metadata
+import os
+import platform
+import tempfile
 import time
-from typing import List, Optional
+from typing import Callable, Dict, List, Optional
 import torch
 from torch.fx.experimental.proxy_tensor import make_fx
 from functorch._src.compile_utils import strip_overloads
@@ -22,18 +28,228 @@ from functorch._src.compile_utils import strip_overloads
 import torch_mlir
 import iree_torch
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Cache keys hash all of a graph's weights, for which blake3 is much faster
+# than sha256.
+try:
+    from blake3 import blake3 as _key_hasher
+except ImportError:
+    from hashlib import sha256 as _key_hasher
+
+# Newer torch-mlir releases can import FX graphs directly, without going
+# through TorchScript first.
+try:
+    from torch_mlir import fx as torch_mlir_fx
+except ImportError:
+    torch_mlir_fx = None
+
 
 DEVICE_TO_IREE_BACKEND = { "cpu" : "llvm-cpu",
                            "cuda" : "cuda" }
 
+# IREE compiler flags that tune code generation for the host, so that it can
+# use all of the host's instruction set extensions (AVX2, AVX-512, NEON, ...).
+# This uses the flag spelling of the older IREE releases that still support
+# `ireec.InputType.TM_TENSOR`, which `iree_torch.compile_to_vmfb` requires.
+# Later releases dropped that input type and renamed the flag to
+# `--iree-llvmcpu-target-cpu`, so they cannot run this POC either way.
+IREE_BACKEND_HOST_CPU_ARGS = { "llvm-cpu" : ["--iree-llvm-target-cpu=host"],
+                               "cuda" : [] }
+
+
+@functools.lru_cache(maxsize=None)
+def _get_host_cpu_id() -> str:
+    """Identify the host CPU model and its instruction set extensions."""
+    cpu_info = {}
+    try:
+        with open("/proc/cpuinfo") as f:
+            # The first processor entry is enough; they all match in practice.
+            for line in f:
+                if not line.strip():
+                    break
+                field, _, value = line.partition(":")
+                cpu_info[field.strip()] = value.strip()
+    except OSError:
+        pass
+    fields = ("model name", "flags", "CPU implementer", "CPU part", "Features")
+    return repr((platform.machine(), platform.processor(),
+                 [cpu_info.get(field) for field in fields]))
+
+
+def _package_version(name: str) -> Optional[str]:
+    try:
+        return importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+_COMPILER_VERSIONS = tuple(
+    _package_version(name) for name in ("torch", "torch-mlir", "iree-compiler"))
+
+
+class _VmfbCache:
+    """An on-disk cache of compiled IREE flatbuffers.
+
+    Entries are keyed by a digest of everything that goes into compiling a
+    graph (see `_graph_cache_key`), so that repeated runs of the same model
+    can skip torch-mlir lowering and IREE compilation entirely. Once the cache
+    grows past `max_size` bytes, the least recently used entries are evicted.
+
+    Set `IREE_TORCH_DISABLE_VMFB_CACHE=1` to bypass the cache, e.g. when using
+    source builds of torch-mlir or IREE, whose changes the key cannot see.
+    """
+
+    def __init__(self, max_size: int = 4 * 2**30):
+        self.max_size = max_size
+        self.suffix = ".vmfb.zst" if zstandard is not None else ".vmfb"
+
+    @staticmethod
+    def is_enabled() -> bool:
+        return not os.environ.get("IREE_TORCH_DISABLE_VMFB_CACHE")
+
+    @staticmethod
+    def get_dir() -> str:
+        # An empty XDG_CACHE_HOME counts as unset.
+        cache_home = (os.environ.get("XDG_CACHE_HOME") or
+                      os.path.join(os.path.expanduser("~"), ".cache"))
+        return os.path.join(cache_home, "iree_torch")
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.get_dir(), key[:32] + self.suffix)
+
+    def get(self, key: str) -> Optional[bytes]:
+        if not self.is_enabled():
+            return None
+        path = self._get_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # Bump the modification time so that eviction order reflects the last
+        # use of an entry rather than when it was written. Another process may
+        # have evicted the entry since we read it, which is fine.
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        if zstandard is not None:
+            try:
+                data = zstandard.ZstdDecompressor().decompress(data)
+            except zstandard.ZstdError:
+                # Treat corrupt entries as misses so the graph is recompiled.
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                return None
+        return data
+
+    def put(self, key: str, flatbuffer: bytes):
+        if not self.is_enabled():
+            return
+        cache_dir = self.get_dir()
+        os.makedirs(cache_dir, exist_ok=True)
+        if zstandard is not None:
+            flatbuffer = zstandard.ZstdCompressor().compress(flatbuffer)
+        # Write to a temporary file first so that concurrent readers never see
+        # a partially written entry.
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(flatbuffer)
+            os.replace(tmp_path, self._get_path(key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.get_dir()):
+            if entry.name.endswith(self.suffix):
+                # Another process may evict entries while we scan.
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+_VMFB_CACHE = _VmfbCache()
+
+# Compiled functions from this process, keyed by `_graph_cache_key`. This lets
+# us reuse compilation results when TorchDynamo recompiles a graph we have
+# already seen, e.g. after its own cache entry was invalidated.
+_COMPILE_CACHE: Dict[str, Callable] = {}
+_COMPILE_CACHE_STATS = collections.Counter()
+
+# Total time in nanoseconds spent in each phase of compiling and running
+# graphs, to tell where the time of an iteration goes.
+_PHASE_NS = collections.defaultdict(int)
+
+
+@contextlib.contextmanager
+def _time_phase(phase: str):
+    start_time = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        _PHASE_NS[phase] += time.perf_counter_ns() - start_time
+
+
+def _graph_cache_key(fx_graph: torch.fx.GraphModule,
+                     example_inputs: List[torch.Tensor], *options) -> str:
+    """Compute a digest identifying the compiled form of `fx_graph`.
+
+    Besides the graph code, this covers the configuration of the submodules
+    called by the graph (e.g. the kernel size of a `MaxPool2d`), all tensors
+    stored on the graph module (they get baked into the compiled module as
+    constants), the input shapes and dtypes, the compiler versions, and any
+    compilation `options`.
+    """
+    hasher = _key_hasher()
+    hasher.update(fx_graph.code.encode())
+    for name, module in fx_graph.named_modules():
+        hasher.update(repr((name, type(module).__qualname__, module.training,
+                            module.extra_repr())).encode())
+    # Unlike `state_dict()`, this includes non-persistent buffers.
+    tensors = list(fx_graph.named_parameters()) + list(fx_graph.named_buffers())
+    for node in fx_graph.graph.nodes:
+        if node.op == "get_attr":
+            attr = functools.reduce(getattr, node.target.split("."), fx_graph)
+            if isinstance(attr, torch.Tensor):
+                tensors.append((node.target, attr))
+    for name, tensor in tensors:
+        hasher.update(repr((name, tensor.shape, tensor.dtype)).encode())
+        flat_tensor = tensor.detach().cpu().contiguous().reshape(-1)
+        hasher.update(flat_tensor.view(torch.uint8).numpy())
+    hasher.update(repr([(t.shape, t.dtype, t.device)
+                        for t in example_inputs]).encode())
+    hasher.update(repr((_COMPILER_VERSIONS, options)).encode())
+    return hasher.hexdigest()
+
 
 def timeit(*, append_time_to: Optional[List] = None):
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            start_time = time.time_ns()
+            start_time = time.perf_counter_ns()
             result = func(*args, **kwargs)
-            end_time = time.time_ns()
+            end_time = time.perf_counter_ns()
 
             if append_time_to is not None:
                 append_time_to.append(end_time - start_time)
@@ -42,14 +258,18 @@ def timeit(*, append_time_to: Optional[List] = None):
     return decorator
 
 
+def _get_output_node(fx_g: torch.fx.GraphModule) -> torch.fx.Node:
+    # A valid graph has exactly one output node, and it is the last node, so
+    # search from the end instead of walking the whole graph.
+    output_node = next(node for node in reversed(fx_g.graph.nodes)
+                       if node.op == "output")
+    assert len(output_node.args) == 1, "Output node must have a single argument"
+    return output_node
+
+
 def _returns_nothing(fx_g: torch.fx.GraphModule) -> bool:
-    for node in fx_g.graph.nodes:
-        if node.op == "output":
-            assert len(node.args) == 1, "Output node must have a single argument"
-            node_arg = node.args[0]
-            if isinstance(node_arg, tuple):
-                return len(node_arg) == 0
-    return False
+    node_arg = _get_output_node(fx_g).args[0]
+    return isinstance(node_arg, tuple) and len(node_arg) == 0
 
 
 def _unwrap_single_tuple_return(fx_g: torch.fx.GraphModule) -> bool:
@@ -57,34 +277,51 @@ def _unwrap_single_tuple_return(fx_g: torch.fx.GraphModule) -> bool:
     Replace tuple with tuple element in functions that return one-element tuples.
     Returns true if an unwrapping took place, and false otherwise.
     """
-    unwrapped_tuple = False
-    for node in fx_g.graph.nodes:
-        if node.op == "output":
-            assert len(node.args) == 1, "Output node must have a single argument"
-            node_arg = node.args[0]
-            if isinstance(node_arg, tuple):
-                if len(node_arg) == 1:
-                    node.args = (node_arg[0],)
-                    unwrapped_tuple = True
-                    break
+    output_node = _get_output_node(fx_g)
+    node_arg = output_node.args[0]
+    if not (isinstance(node_arg, tuple) and len(node_arg) == 1):
+        return False
 
-    if unwrapped_tuple:
+    output_node.args = (node_arg[0],)
+    # Linting walks the whole graph, and replacing the output with an existing
+    # node cannot make the graph invalid, so only do it when debugging.
+    if os.environ.get("TORCHBENCH_DEBUG"):
         fx_g.graph.lint()
-        fx_g.recompile()
-    return unwrapped_tuple
+    fx_g.recompile()
+    return True
 
 
-def make_torch_mlir_compiler(use_tracing: bool, device: str, verbose=False):
-    def compiler(fx_graph: torch.fx.GraphModule,
-                 example_inputs: List[torch.Tensor]):
-        """Compile GraphModule using torch-mlir + IREE."""
+def _lower_with_fx_importer(fx_graph: torch.fx.GraphModule,
+                            example_inputs: List[torch.Tensor], verbose: bool):
+    """Lower `fx_graph` to linalg-on-tensors with torch-mlir's FX importer.
+
+    Returns None if the importer is not available or cannot handle the graph.
+    """
+    if torch_mlir_fx is None:
+        return None
+    start_time = time.perf_counter_ns()
+    try:
+        # The importer names the entry point `main` by default, but the
+        # compiled module is invoked as `forward`.
+        linalg_module = torch_mlir_fx.export_and_import(
+            fx_graph, *example_inputs, output_type="linalg-on-tensors",
+            func_name="forward")
+    except Exception as err:
+        # Keep the time of failed attempts separate from the lowering that
+        # the TorchScript fallback does next.
+        _PHASE_NS["Failed FX import"] += time.perf_counter_ns() - start_time
         if verbose:
-            print("Compiling graph...")
+            print(f"FX importer failed, falling back to TorchScript: {err}")
+        return None
+    _PHASE_NS["torch-mlir lowering"] += time.perf_counter_ns() - start_time
+    return linalg_module
 
-        if _returns_nothing(fx_graph):
-            return fx_graph
 
-        was_unwrapped = _unwrap_single_tuple_return(fx_graph)
+def _lower_with_torchscript(fx_graph: torch.fx.GraphModule,
+                            example_inputs: List[torch.Tensor],
+                            use_tracing: bool, verbose: bool):
+    """Lower `fx_graph` to linalg-on-tensors by way of TorchScript."""
+    with _time_phase("TorchScript conversion"):
         fx_graph = make_fx(fx_graph)(*example_inputs)
         strip_overloads(fx_graph)
 
@@ -95,25 +332,97 @@ def make_torch_mlir_compiler(use_tracing: bool, device: str, verbose=False):
         ts_compiler = torch.jit.trace if use_tracing else torch.jit.script
         ts_graph = ts_compiler(fx_graph, example_inputs)
 
-        if verbose:
-            torch_mlir_module = torch_mlir.compile(
-                ts_graph, example_inputs,
-                output_type=torch_mlir.OutputType.TORCH)
-            print("\n\ntorch-mlir backend contract graph:")
-            print(torch_mlir_module)
+    if verbose:
+        torch_mlir_module = torch_mlir.compile(
+            ts_graph, example_inputs,
+            output_type=torch_mlir.OutputType.TORCH)
+        print("\n\ntorch-mlir backend contract graph:")
+        print(torch_mlir_module)
 
-        linalg_module = torch_mlir.compile(
+    with _time_phase("torch-mlir lowering"):
+        return torch_mlir.compile(
             ts_graph, example_inputs,
             output_type=torch_mlir.OutputType.LINALG_ON_TENSORS)
+
+
+def _compile_to_vmfb(fx_graph: torch.fx.GraphModule,
+                     example_inputs: List[torch.Tensor], use_tracing: bool,
+                     backend: str, arch: Optional[str], extra_args: List[str],
+                     verbose: bool) -> bytes:
+    linalg_module = _lower_with_fx_importer(fx_graph, example_inputs, verbose)
+    if linalg_module is None:
+        linalg_module = _lower_with_torchscript(fx_graph, example_inputs,
+                                                use_tracing, verbose)
+    with _time_phase("IREE compilation"):
+        return iree_torch.compile_to_vmfb(linalg_module, backend, arch,
+                                          extra_args)
+
+
+def _load_vmfb(flatbuffer: bytes, backend: str):
+    with _time_phase("IREE loading"):
+        loaded_module = iree_torch.load_vmfb(flatbuffer, backend)
+    if not hasattr(loaded_module, "forward"):
+        raise RuntimeError("Compiled IREE module has no `forward` function")
+    return loaded_module
+
+
+def make_torch_mlir_compiler(use_tracing: bool, device: str, verbose=False,
+                             target_host_cpu=False):
+    def compiler(fx_graph: torch.fx.GraphModule,
+                 example_inputs: List[torch.Tensor]):
+        """Compile GraphModule using torch-mlir + IREE."""
+        if verbose:
+            print("Compiling graph...")
+
+        if _returns_nothing(fx_graph):
+            return fx_graph
+
+        was_unwrapped = _unwrap_single_tuple_return(fx_graph)
         backend = DEVICE_TO_IREE_BACKEND[device]
         arch = "sm_80" if device == "cuda" else None
-        compiled_module = iree_torch.compile_to_vmfb(linalg_module, backend, arch)
-        loaded_module = iree_torch.load_vmfb(compiled_module, backend)
+        extra_args = []
+        if target_host_cpu:
+            extra_args = IREE_BACKEND_HOST_CPU_ARGS[backend]
+
+        with _time_phase("Cache key computation"):
+            # Host-specific code generation makes flatbuffers unsafe to
+            # share between different CPUs, so also key on the host CPU.
+            host_cpu_id = _get_host_cpu_id() if target_host_cpu else None
+            # `lambda x: (x,)` unwraps to the same graph as `lambda x: x`, but
+            # their compiled functions must rewrap the result differently.
+            cache_key = _graph_cache_key(fx_graph, example_inputs,
+                                         use_tracing, backend, arch,
+                                         extra_args, host_cpu_id,
+                                         was_unwrapped)
+        if cache_key in _COMPILE_CACHE:
+            _COMPILE_CACHE_STATS["memory_hits"] += 1
+            if verbose:
+                print("Using previously compiled function.")
+            return _COMPILE_CACHE[cache_key]
+
+        compiled_module = _VMFB_CACHE.get(cache_key)
+        if compiled_module is None:
+            _COMPILE_CACHE_STATS["misses"] += 1
+            compiled_module = _compile_to_vmfb(fx_graph, example_inputs,
+                                               use_tracing, backend, arch,
+                                               extra_args, verbose)
+            # Only cache flatbuffers that load and can actually be called.
+            loaded_module = _load_vmfb(compiled_module, backend)
+            _VMFB_CACHE.put(cache_key, compiled_module)
+        else:
+            _COMPILE_CACHE_STATS["disk_hits"] += 1
+            if verbose:
+                print("Using cached IREE flatbuffer.")
+            loaded_module = _load_vmfb(compiled_module, backend)
 
         def forward(*inputs):
+            # This is timed inline since it runs on every iteration.
+            start_time = time.perf_counter_ns()
             result = loaded_module.forward(*inputs)
+            _PHASE_NS["IREE execution"] += time.perf_counter_ns() - start_time
             result = tuple() if result is None else result
             return (result,) if was_unwrapped else result
+        _COMPILE_CACHE[cache_key] = forward
         return forward
 
     return compiler
@@ -137,3 +446,16 @@ def print_time_stats(times):
     print(f"90%ile: {quantile_ms(0.9)} ms")
     print(f"Total: {torch.sum(times_tensor) / 1e6} ms")
     print()
+
+
+def print_compile_cache_stats():
+    print(f"Compiled graphs: {_COMPILE_CACHE_STATS['misses']}")
+    print(f"In-memory cache hits: {_COMPILE_CACHE_STATS['memory_hits']}")
+    print(f"On-disk cache hits: {_COMPILE_CACHE_STATS['disk_hits']}")
+    print()
+
+
+def print_phase_times():
+    for phase, ns in _PHASE_NS.items():
+        print(f"{phase}: {ns / 1e6} ms")
+    print()